@@ -3,14 +3,20 @@ VisionAid FastAPI Web Application
 Simple web interface for Vision to Speech conversion
 """
 import os
+import time
 import uuid
-import shutil
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Dict
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
 
@@ -42,7 +48,98 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Add CORS middleware
+# Upload ingestion limits
+MAX_UPLOAD_BYTES = config.max_upload_bytes
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Allowance for multipart boundaries and form fields on top of the image itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# Limits how many upload bodies are received at the same time
+upload_semaphore = asyncio.Semaphore(config.max_concurrent_uploads)
+UPLOAD_PATHS = ("/upload", "/upload-async")
+# Max wait for an upload slot (503 after) and for the whole body to arrive (408 after)
+UPLOAD_SLOT_TIMEOUT_SECONDS = 10
+UPLOAD_BODY_TIMEOUT_SECONDS = 60
+
+# Magic bytes of image formats accepted by Gemini: (signature, extension, MIME type)
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", ".jpg", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", ".png", "image/png"),
+]
+# ISO-BMFF "ftyp" brands of HEIC/HEIF images
+HEIC_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx"}
+HEIF_BRANDS = {b"mif1", b"msf1", b"heif"}
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware bounding upload bodies before the multipart parser spools them
+    
+    The upload semaphore is acquired before the first body byte is read and released
+    once the body is fully received. Body bytes are counted as they arrive, so requests
+    without Content-Length (chunked) get a 413 as soon as the limit is passed. Slow
+    clients cannot hold a slot forever: waiting for a slot is limited (503) and so is
+    receiving the body (408).
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in UPLOAD_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        max_body_bytes = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > max_body_bytes:
+            await JSONResponse(status_code=413, content={"detail": "File too large"})(scope, receive, send)
+            return
+        
+        try:
+            await asyncio.wait_for(upload_semaphore.acquire(), UPLOAD_SLOT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            await JSONResponse(status_code=503, content={"detail": "Too many uploads, try again later"})(scope, receive, send)
+            return
+        
+        deadline = time.monotonic() + UPLOAD_BODY_TIMEOUT_SECONDS
+        state = {"received": 0, "released": False, "body_done": False}
+        
+        def release():
+            if not state["released"]:
+                state["released"] = True
+                upload_semaphore.release()
+        
+        async def limited_receive():
+            if state["body_done"]:
+                return await receive()
+            try:
+                message = await asyncio.wait_for(receive(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                state["body_done"] = True
+                release()
+                raise HTTPException(status_code=408, detail="Upload timed out")
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > max_body_bytes:
+                    state["body_done"] = True
+                    release()
+                    raise HTTPException(status_code=413, detail="File too large")
+                if not message.get("more_body", False):
+                    state["body_done"] = True
+                    release()
+            else:
+                state["body_done"] = True
+                release()
+            return message
+        
+        try:
+            await self.app(scope, limited_receive, send)
+        finally:
+            release()
+
+app.add_middleware(UploadLimitMiddleware)
+
+# Add CORS middleware (added last so it wraps the upload limit's own 413/503 responses)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -66,6 +163,18 @@ def get_vts_instance():
         vts_instance = VTS()
     return vts_instance
 
+# Paginated TTS: chunks synthesized up front and ahead of the playback position
+AUDIO_PREFETCH_CHUNKS = 2
+AUDIO_PREFETCH_AHEAD = 1
+# Sessions not accessed for this long are ended, checked every AUDIO_SESSION_SWEEP_SECONDS
+AUDIO_SESSION_IDLE_SECONDS = 600
+AUDIO_SESSION_SWEEP_SECONDS = 60
+# Strong reference to the sweeper task (the event loop only keeps weak ones)
+audio_session_sweeper = None
+
+# Worker pool for on-demand chunk synthesis
+tts_executor = ThreadPoolExecutor(max_workers=4)
+
 # Pydantic models
 class ConversionResponse(BaseModel):
     success: bool
@@ -74,6 +183,12 @@ class ConversionResponse(BaseModel):
     audio_url: Optional[str] = None
     audio_filename: Optional[str] = None
     voice_used: Optional[str] = None
+    token_usage: Optional[Dict[str, int]] = None
+    truncated: Optional[bool] = None
+    task_id: Optional[str] = None
+    total_chunks: Optional[int] = None
+    image_sha256: Optional[str] = None
+    cached: bool = False  # True when reused from conversion_cache (no Gemini/TTS call)
     error: Optional[str] = None
 
 class ConversionStatus(BaseModel):
@@ -85,6 +200,191 @@ class ConversionStatus(BaseModel):
 # In-memory task storage (in production, use Redis or database)
 conversion_tasks = {}
 
+# Finished conversions keyed by (image SHA-256, voice ID, category), LRU-bounded
+CONVERSION_CACHE_SIZE = 256
+conversion_cache = OrderedDict()
+
+def get_cached_conversion(key: tuple) -> Optional[ConversionResponse]:
+    """
+    Get a cached conversion result if its MP3 still exists
+    
+    Returns a copy flagged as cached and without token_usage, since no Gemini
+    call was made for this request.
+    """
+    response = conversion_cache.get(key)
+    if response is None:
+        return None
+    if not (OUTPUT_DIR / response.audio_filename).exists():
+        del conversion_cache[key]
+        return None
+    conversion_cache.move_to_end(key)
+    return response.model_copy(update={"token_usage": None, "cached": True})
+
+def store_cached_conversion(key: tuple, response: ConversionResponse):
+    """Cache a finished single-file conversion so identical uploads skip Gemini/TTS"""
+    conversion_cache[key] = response
+    conversion_cache.move_to_end(key)
+    while len(conversion_cache) > CONVERSION_CACHE_SIZE:
+        conversion_cache.popitem(last=False)
+
+def create_audio_session(task_id: str, result: dict, voice_id: str, output_path: str):
+    """
+    Register a paginated audio session for a task
+    
+    Chunks already synthesized by VTS.convert are stored as completed futures,
+    the rest are synthesized on demand by get_task_audio_chunk.
+    """
+    futures = {}
+    for index, path in enumerate(result["audio_chunks"]):
+        if path is not None:
+            future = Future()
+            future.set_result(path)
+            futures[index] = future
+    
+    conversion_tasks.setdefault(task_id, {"status": "completed", "progress": 100, "result": None})
+    conversion_tasks[task_id]["audio_session"] = {
+        "voice_id": voice_id,
+        "text_chunks": result["text_chunks"],
+        "base_path": output_path,
+        "futures": futures,
+        "lock": threading.Lock(),
+        "closed": False,
+        "last_access": time.time()
+    }
+
+def synthesize_chunk(session: dict, index: int) -> str:
+    """Synthesize one chunk of an audio session (runs in tts_executor)"""
+    vts = get_vts_instance()
+    return vts.synthesize(
+        session["text_chunks"][index],
+        VTS.chunk_path(session["base_path"], index),
+        voice_id=session["voice_id"]
+    )
+
+def remove_chunk_file(future: Future):
+    """Done-callback removing the MP3 of a finished chunk"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        os.remove(future.result())
+    except:
+        pass
+
+def schedule_chunk(session: dict, index: int) -> Optional[Future]:
+    """Get the future of a chunk, scheduling its synthesis if needed"""
+    if index < 0 or index >= len(session["text_chunks"]):
+        return None
+    with session["lock"]:
+        if session["closed"]:
+            return None
+        future = session["futures"].get(index)
+        # Resubmit chunks that failed or were cancelled while the session is open
+        if future is None or future.cancelled() or (future.done() and future.exception() is not None):
+            future = tts_executor.submit(synthesize_chunk, session, index)
+            session["futures"][index] = future
+        return future
+
+def close_audio_session(session: dict):
+    """Cancel unplayed chunks and remove synthesized chunk files"""
+    with session["lock"]:
+        session["closed"] = True
+        for index, future in session["futures"].items():
+            if future.cancel():
+                continue
+            # Runs now if done, or when a chunk still being synthesized finishes
+            future.add_done_callback(remove_chunk_file)
+
+def validate_category(category: Optional[str]) -> Optional[str]:
+    """Normalize the optional category form field, rejecting unknown values (400)"""
+    if not category:
+        return None
+    if category not in ("Tài liệu", "Hóa đơn", "Ngữ cảnh"):
+        raise HTTPException(status_code=400, detail="Unsupported category")
+    return category
+
+def end_task_audio_session(task_data: dict):
+    """Close a task's audio session and drop it so its chunks and futures can be freed"""
+    session = task_data.pop("audio_session", None)
+    if session is not None:
+        close_audio_session(session)
+        task_data["audio_session_ended"] = True
+
+def expire_idle_audio_sessions():
+    """End audio sessions whose client stopped fetching chunks"""
+    now = time.time()
+    for task_data in list(conversion_tasks.values()):
+        session = task_data.get("audio_session")
+        if session is not None and now - session["last_access"] > AUDIO_SESSION_IDLE_SECONDS:
+            end_task_audio_session(task_data)
+
+def sniff_image_type(header: bytes) -> Optional[tuple]:
+    """
+    Detect image format from magic bytes
+    
+    Returns:
+        (extension, MIME type) or None if the format is not supported
+    """
+    for signature, extension, mime_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extension, mime_type
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp", "image/webp"
+    if header[4:8] == b"ftyp":
+        if header[8:12] in HEIC_BRANDS:
+            return ".heic", "image/heic"
+        if header[8:12] in HEIF_BRANDS:
+            return ".heif", "image/heif"
+    return None
+
+async def ingest_upload(file: UploadFile, unique_id: str) -> dict:
+    """
+    Stream an uploaded image to UPLOAD_DIR with early validation
+    
+    The format is checked from the first chunk's magic bytes before anything is
+    written, the size limit is enforced while reading (413 once exceeded) and the
+    SHA-256 is computed incrementally. The request body itself is bounded earlier
+    by UploadLimitMiddleware.
+    
+    Returns:
+        Dict with path, mime_type, sha256 and size of the stored image
+    """
+    first_chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    if not first_chunk:
+        raise HTTPException(status_code=400, detail="Empty file")
+    
+    image_type = sniff_image_type(first_chunk)
+    if image_type is None:
+        raise HTTPException(status_code=400, detail="Unsupported image format")
+    file_extension, mime_type = image_type
+    
+    upload_path = UPLOAD_DIR / f"{unique_id}{file_extension}"
+    digest = hashlib.sha256()
+    size = 0
+    
+    try:
+        with open(upload_path, "wb") as buffer:
+            chunk = first_chunk
+            while chunk:
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                digest.update(chunk)
+                buffer.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    except:
+        try:
+            os.remove(upload_path)
+        except:
+            pass
+        raise
+    
+    return {
+        "path": upload_path,
+        "mime_type": mime_type,
+        "sha256": digest.hexdigest(),
+        "size": size
+    }
+
 @app.get("/", response_class=HTMLResponse)
 async def home():
     """Serve the main HTML page"""
@@ -94,44 +394,56 @@ async def home():
 async def upload_image(
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    voice_id: str = Form("JBFqnCBsd6RMkjVDRZzb")
+    voice_id: str = Form("JBFqnCBsd6RMkjVDRZzb"),
+    paginated: bool = Form(False),
+    category: Optional[str] = Form(None)
 ):
     """
     Upload image and convert to speech
+    
+    With paginated=true, long documents are synthesized chunk by chunk:
+    fetch audio from /tasks/{task_id}/audio/{n} as playback progresses.
+    category ("Tài liệu", "Hóa đơn", "Ngữ cảnh") can be set when the client
+    already knows the kind of image, e.g. scene mode, to get a shorter answer.
     """
+    category = validate_category(category)
 
     print(f"[START] /upload")
     start_time = time.time()
-    # Validate file type
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="File must be an image")
+    
+    # Validate and save uploaded file
+    unique_id = str(uuid.uuid4())
+    upload = await ingest_upload(file, unique_id)
+    upload_path = upload["path"]
+    
+    # Same image, voice and category already converted: reuse the result
+    cache_key = (upload["sha256"], voice_id, category)
+    cached = get_cached_conversion(cache_key)
+    if cached is not None:
+        try:
+            os.remove(upload_path)
+        except:
+            pass
+        return cached
     
     try:
-        # Generate unique filename
-        file_extension = Path(file.filename).suffix.lower()
-        if file_extension not in [".jpg", ".jpeg", ".png", ".bmp", ".gif"]:
-            raise HTTPException(status_code=400, detail="Unsupported image format")
-        
-        unique_id = str(uuid.uuid4())
-        upload_filename = f"{unique_id}{file_extension}"
-        upload_path = UPLOAD_DIR / upload_filename
-        
-        # Save uploaded file
-        with open(upload_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
         # Generate output filename
         output_filename = f"{unique_id}.mp3"
         output_path = OUTPUT_DIR / output_filename
         
         # Get VTS instance
         vts = get_vts_instance()
-        vts.set_voice(voice_id)
         
-        # Perform conversion
-        result = vts.convert(
+        # Perform conversion off the event loop so chunk requests keep being served
+        result = await run_in_threadpool(
+            vts.convert,
             image_path=str(upload_path),
-            output_mp3_path=str(output_path)
+            output_mp3_path=str(output_path),
+            paginated=paginated,
+            prefetch_chunks=AUDIO_PREFETCH_CHUNKS,
+            mime_type=upload["mime_type"],
+            category=category,
+            voice_id=voice_id
         )
         
         # Clean up uploaded file
@@ -140,15 +452,34 @@ async def upload_image(
         except:
             pass
         
-        if result["success"]:
+        if result["success"] and result.get("audio_chunks"):
+            create_audio_session(unique_id, result, voice_id, str(output_path))
             return ConversionResponse(
+                success=True,
+                message="Conversion started, audio is delivered in chunks",
+                text_result=result["text_result"],
+                audio_url=f"/tasks/{unique_id}/audio/0",
+                voice_used=result["voice_id"],
+                token_usage=result.get("token_usage"),
+                truncated=result.get("truncated"),
+                image_sha256=upload["sha256"],
+                task_id=unique_id,
+                total_chunks=len(result["audio_chunks"])
+            )
+        elif result["success"]:
+            response = ConversionResponse(
                 success=True,
                 message="Conversion completed successfully!",
                 text_result=result["text_result"],
                 audio_url=f"/outputs/{output_filename}",
                 audio_filename=output_filename,
-                voice_used=result["voice_id"]
+                voice_used=result["voice_id"],
+                token_usage=result.get("token_usage"),
+                truncated=result.get("truncated"),
+                image_sha256=upload["sha256"]
             )
+            store_cached_conversion(cache_key, response)
+            return response
         else:
             # Clean up output file if exists
             try:
@@ -179,19 +510,36 @@ async def upload_image(
 async def upload_image_async(
     background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    voice_id: str = Form("JBFqnCBsd6RMkjVDRZzb")
+    voice_id: str = Form("JBFqnCBsd6RMkjVDRZzb"),
+    paginated: bool = Form(False),
+    category: Optional[str] = Form(None)
 ):
     """
     Upload image and convert to speech asynchronously
     Returns task ID for status checking
     """
-    # Validate file type
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="File must be an image")
+    category = validate_category(category)
+    
+    # Validate and save uploaded file before the request (and its body) is closed
+    upload = await ingest_upload(file, str(uuid.uuid4()))
     
     # Generate task ID
     task_id = str(uuid.uuid4())
     
+    # Same image, voice and category already converted: reuse the result
+    cached = get_cached_conversion((upload["sha256"], voice_id, category))
+    if cached is not None:
+        try:
+            os.remove(upload["path"])
+        except:
+            pass
+        conversion_tasks[task_id] = {
+            "status": "completed",
+            "progress": 100,
+            "result": cached
+        }
+        return {"task_id": task_id, "message": "Processing started"}
+    
     # Initialize task status
     conversion_tasks[task_id] = {
         "status": "processing",
@@ -203,27 +551,20 @@ async def upload_image_async(
     background_tasks.add_task(
         process_conversion_async, 
         task_id, 
-        file, 
-        voice_id
+        upload, 
+        voice_id,
+        paginated,
+        category
     )
     
     return {"task_id": task_id, "message": "Processing started"}
 
-async def process_conversion_async(task_id: str, file: UploadFile, voice_id: str):
+async def process_conversion_async(task_id: str, upload: dict, voice_id: str, paginated: bool = False, category: Optional[str] = None):
     """Background task for processing conversion"""
     try:
-        # Update status
-        conversion_tasks[task_id]["progress"] = 10
-        
-        # Generate unique filename
-        file_extension = Path(file.filename).suffix.lower()
-        unique_id = str(uuid.uuid4())
-        upload_filename = f"{unique_id}{file_extension}"
-        upload_path = UPLOAD_DIR / upload_filename
-        
-        # Save uploaded file
-        with open(upload_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Uploaded file was already saved by ingest_upload
+        upload_path = upload["path"]
+        unique_id = upload_path.stem
         
         conversion_tasks[task_id]["progress"] = 30
         
@@ -233,14 +574,19 @@ async def process_conversion_async(task_id: str, file: UploadFile, voice_id: str
         
         # Get VTS instance
         vts = get_vts_instance()
-        vts.set_voice(voice_id)
         
         conversion_tasks[task_id]["progress"] = 50
         
-        # Perform conversion
-        result = vts.convert(
+        # Perform conversion off the event loop so chunk requests keep being served
+        result = await run_in_threadpool(
+            vts.convert,
             image_path=str(upload_path),
-            output_mp3_path=str(output_path)
+            output_mp3_path=str(output_path),
+            paginated=paginated,
+            prefetch_chunks=AUDIO_PREFETCH_CHUNKS,
+            mime_type=upload["mime_type"],
+            category=category,
+            voice_id=voice_id
         )
         
         conversion_tasks[task_id]["progress"] = 90
@@ -251,19 +597,42 @@ async def process_conversion_async(task_id: str, file: UploadFile, voice_id: str
         except:
             pass
         
-        if result["success"]:
+        if result["success"] and result.get("audio_chunks"):
+            create_audio_session(task_id, result, voice_id, str(output_path))
             conversion_tasks[task_id].update({
                 "status": "completed",
                 "progress": 100,
                 "result": ConversionResponse(
                     success=True,
-                    message="Conversion completed successfully!",
+                    message="Conversion started, audio is delivered in chunks",
                     text_result=result["text_result"],
-                    audio_url=f"/outputs/{output_filename}",
-                    audio_filename=output_filename,
-                    voice_used=result["voice_id"]
+                    audio_url=f"/tasks/{task_id}/audio/0",
+                    voice_used=result["voice_id"],
+                    token_usage=result.get("token_usage"),
+                    truncated=result.get("truncated"),
+                    image_sha256=upload["sha256"],
+                    task_id=task_id,
+                    total_chunks=len(result["audio_chunks"])
                 )
             })
+        elif result["success"]:
+            response = ConversionResponse(
+                success=True,
+                message="Conversion completed successfully!",
+                text_result=result["text_result"],
+                audio_url=f"/outputs/{output_filename}",
+                audio_filename=output_filename,
+                voice_used=result["voice_id"],
+                token_usage=result.get("token_usage"),
+                truncated=result.get("truncated"),
+                image_sha256=upload["sha256"]
+            )
+            store_cached_conversion((upload["sha256"], voice_id, category), response)
+            conversion_tasks[task_id].update({
+                "status": "completed",
+                "progress": 100,
+                "result": response
+            })
         else:
             # Clean up output file if exists
             try:
@@ -283,6 +652,13 @@ async def process_conversion_async(task_id: str, file: UploadFile, voice_id: str
             })
     
     except Exception as e:
+        # Clean up uploaded file
+        try:
+            if os.path.exists(upload["path"]):
+                os.remove(upload["path"])
+        except:
+            pass
+        
         conversion_tasks[task_id].update({
             "status": "failed",
             "progress": 100,
@@ -307,6 +683,62 @@ async def get_conversion_status(task_id: str):
         result=task_data["result"]
     )
 
+@app.get("/tasks/{task_id}/audio/{chunk_index}")
+async def get_task_audio_chunk(task_id: str, chunk_index: int):
+    """
+    Get one audio chunk of a paginated conversion
+    
+    Synthesizes the chunk if needed and prefetches the next ones
+    so they are ready when playback reaches them.
+    """
+    task_data = conversion_tasks.get(task_id)
+    if task_data is not None and task_data.get("audio_session_ended"):
+        raise HTTPException(status_code=410, detail="Audio session ended")
+    if task_data is None or "audio_session" not in task_data:
+        raise HTTPException(status_code=404, detail="Audio session not found")
+    
+    session = task_data["audio_session"]
+    session["last_access"] = time.time()
+    future = schedule_chunk(session, chunk_index)
+    if future is None:
+        if session["closed"]:
+            raise HTTPException(status_code=410, detail="Audio session ended")
+        raise HTTPException(status_code=404, detail="Audio chunk not found")
+    
+    for ahead in range(chunk_index + 1, chunk_index + 1 + AUDIO_PREFETCH_AHEAD):
+        schedule_chunk(session, ahead)
+    
+    try:
+        # Shield so a disconnecting client does not cancel work shared with other requests
+        path = await asyncio.shield(asyncio.wrap_future(future))
+    except asyncio.CancelledError:
+        if not session["closed"]:
+            raise
+        raise HTTPException(status_code=410, detail="Audio session ended")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
+    
+    if not os.path.exists(path):
+        raise HTTPException(status_code=410, detail="Audio session ended")
+    
+    return FileResponse(
+        path,
+        media_type="audio/mpeg",
+        headers={"X-Total-Chunks": str(len(session["text_chunks"]))}
+    )
+
+@app.delete("/tasks/{task_id}/audio")
+async def end_audio_session(task_id: str):
+    """End a paginated audio session and cancel unplayed chunks"""
+    task_data = conversion_tasks.get(task_id)
+    if task_data is not None and task_data.get("audio_session_ended"):
+        raise HTTPException(status_code=410, detail="Audio session ended")
+    if task_data is None or "audio_session" not in task_data:
+        raise HTTPException(status_code=404, detail="Audio session not found")
+    
+    end_task_audio_session(task_data)
+    return {"task_id": task_id, "message": "Audio session ended"}
+
 @app.get("/voices")
 async def get_available_voices():
     """Get list of available TTS voices"""
@@ -320,6 +752,12 @@ async def get_available_voices():
         ]
     }
 
+@app.get("/usage")
+async def get_token_usage():
+    """Get cumulative Gemini token usage since startup"""
+    vts = get_vts_instance()
+    return {"token_usage": vts.get_token_usage()}
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -340,8 +778,19 @@ async def health_check():
 # Cleanup old files periodically
 @app.on_event("startup")
 async def startup_event():
-    """Clean up old files on startup"""
+    """Clean up old files on startup and start the audio session sweeper"""
+    global audio_session_sweeper
     cleanup_old_files()
+    audio_session_sweeper = asyncio.create_task(sweep_audio_sessions())
+
+async def sweep_audio_sessions():
+    """Periodically end idle audio sessions, cancelling their unplayed chunks"""
+    while True:
+        await asyncio.sleep(AUDIO_SESSION_SWEEP_SECONDS)
+        try:
+            expire_idle_audio_sessions()
+        except Exception as e:
+            print(f"⚠️  Audio session sweep failed: {e}")
 
 def cleanup_old_files():
     """Remove files older than 1 hour"""
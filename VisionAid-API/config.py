@@ -74,6 +74,16 @@ class Config:
         """Get default ElevenLabs voice ID"""
         return os.getenv("DEFAULT_VOICE_ID", "JBFqnCBsd6RMkjVDRZzb")
     
+    @property
+    def max_upload_bytes(self) -> int:
+        """Get maximum accepted image upload size in bytes (MAX_UPLOAD_MB, default: 10)"""
+        return int(float(os.getenv("MAX_UPLOAD_MB", "10")) * 1024 * 1024)
+    
+    @property
+    def max_concurrent_uploads(self) -> int:
+        """Get maximum number of uploads ingested at the same time (default: 8)"""
+        return int(os.getenv("MAX_CONCURRENT_UPLOADS", "8"))
+    
     def validate(self) -> bool:
         """
         Validate that all required configuration is present
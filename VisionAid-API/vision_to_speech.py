@@ -4,11 +4,13 @@ Simple and powerful API for converting images to speech, designed to help visual
 access visual information through audio.
 """
 import os
+import re
 import time
+import unicodedata
 import requests
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from google import genai
-from google.genai import types
+from google.genai import types, errors
 from elevenlabs.client import ElevenLabs
 from config import get_config
 
@@ -43,6 +45,41 @@ class VTS:
         self.voice_id = voice_id or config.default_voice_id
         self.model = "gemini-2.5-flash-lite"
         
+        # Output token caps per category (scenes should be short, documents must not be cut)
+        self.max_output_tokens = {
+            "Tài liệu": 16384,
+            "Hóa đơn": 1024,
+            "Ngữ cảnh": 256,
+        }
+        self.temperature = 0.2
+        
+        # Gemini cached content for the static system instruction.
+        # Explicit caching needs at least cache_min_tokens; the default prompt below is only
+        # a few hundred tokens, so today caching stays off after one count_tokens call and
+        # requests send it as a plain system instruction. It kicks in if the prompt grows.
+        self.cache_ttl_seconds = 3600
+        self.cache_min_tokens = 1024
+        self._cache_size_checked = False
+        self._cache_name = None
+        self._cache_expires_at = 0.0
+        self._cache_unavailable = False
+        # Backoff after transient cache errors (network, 429, 5xx)
+        self.cache_retry_max_seconds = 600
+        self._cache_retry_at = 0.0
+        self._cache_backoff_seconds = 0.0
+        
+        # Paginated TTS: max characters per audio chunk for long documents
+        self.chunk_max_chars = 800
+        
+        # Cumulative token usage across all requests
+        self.token_usage = {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "output_tokens": 0,
+            "total_tokens": 0,
+        }
+        
         print(f"[DEBUG] ElevenLabs API Key: {elevenlabs_api_key or config.elevenlabs_api_key}")
 
         # Enhanced prompt with danger detection
@@ -55,22 +92,272 @@ Nhiệm vụ:
 2. Nếu thể loại là [Ngữ cảnh], hãy kiểm tra vật thể nguy hiểm (lửa, dao, xe đang chạy, hố sâu...):
    - Nếu có → thêm dòng "⚠️ Cảnh báo: ..." ngắn gọn, dễ hiểu.
    - Nếu không → ghi "Không phát hiện nguy hiểm."
+3. Với [Ngữ cảnh], mô tả ngắn gọn trong 2-3 câu.
 Format trả kết quả:
 Thể loại: [Tài liệu | Hóa đơn | Ngữ cảnh]
 Nội dung: <nội dung tương ứng>
 """
+    
+    def _get_cached_content(self) -> Optional[str]:
+        """
+        Get (or create) a Gemini cached content holding the system instruction
+        
+        Returns:
+            Cache name, or None if caching is not available for this model/prompt
+        """
+        if self._cache_unavailable or time.time() < self._cache_retry_at:
+            return None
+        
+        # Refresh a bit before expiry so requests never hit an expired cache
+        if self._cache_name and time.time() < self._cache_expires_at - 60:
+            return self._cache_name
+        
+        try:
+            # Check the size once instead of paying a failing caches.create per process
+            if not self._cache_size_checked:
+                counted = self.gemini_client.models.count_tokens(
+                    model=self.model,
+                    contents=self.prompt
+                )
+                self._cache_size_checked = True
+                if (counted.total_tokens or 0) < self.cache_min_tokens:
+                    print(f"ℹ️  Prompt ({counted.total_tokens} tokens) quá ngắn để cache, dùng system instruction")
+                    self._cache_unavailable = True
+                    return None
             
-    def convert(self, image_path: str, output_mp3_path: str) -> Dict[str, Any]:
+            cache = self.gemini_client.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=self.prompt,
+                    ttl=f"{self.cache_ttl_seconds}s",
+                )
+            )
+            self._cache_name = cache.name
+            self._cache_expires_at = time.time() + self.cache_ttl_seconds
+            self._cache_backoff_seconds = 0.0
+            return self._cache_name
+        except errors.ClientError as e:
+            self._cache_name = None
+            if e.code == 429:
+                self._schedule_cache_retry(e)
+            else:
+                # e.g. prompt below the minimum cacheable token count, model unsupported
+                print(f"⚠️  Gemini cache không khả dụng, dùng system instruction: {e}")
+                self._cache_unavailable = True
+            return None
+        except Exception as e:
+            # Server error or network failure: retry later
+            self._cache_name = None
+            self._schedule_cache_retry(e)
+            return None
+    
+    def _schedule_cache_retry(self, error: Exception):
+        """Skip the cache for an exponentially growing delay after a transient error"""
+        self._cache_backoff_seconds = min(
+            max(self._cache_backoff_seconds * 2, 30.0),
+            self.cache_retry_max_seconds
+        )
+        self._cache_retry_at = time.time() + self._cache_backoff_seconds
+        print(f"⚠️  Lỗi tạm thời khi tạo Gemini cache, thử lại sau {self._cache_backoff_seconds:.0f}s: {error}")
+    
+    def _build_generation_config(self, category: Optional[str] = None) -> types.GenerateContentConfig:
+        """
+        Build Gemini generation config with system instruction/cache and token cap
+        
+        Args:
+            category (str, optional): Expected category ("Tài liệu", "Hóa đơn", "Ngữ cảnh").
+                If not given, the largest cap is used since the model decides the category.
+        """
+        if category is not None and category not in self.max_output_tokens:
+            raise ValueError(f"Thể loại không hợp lệ: {category}")
+        if category in self.max_output_tokens:
+            max_tokens = self.max_output_tokens[category]
+        else:
+            max_tokens = max(self.max_output_tokens.values())
+        
+        cache_name = self._get_cached_content()
+        if cache_name:
+            return types.GenerateContentConfig(
+                cached_content=cache_name,
+                max_output_tokens=max_tokens,
+                temperature=self.temperature,
+            )
+        return types.GenerateContentConfig(
+            system_instruction=self.prompt,
+            max_output_tokens=max_tokens,
+            temperature=self.temperature,
+        )
+    
+    def _record_usage(self, response) -> Dict[str, int]:
+        """
+        Record token counts from Gemini response metadata
+        
+        Returns:
+            Dict with token counts for this request
+        """
+        metadata = getattr(response, "usage_metadata", None)
+        usage = {
+            "prompt_tokens": getattr(metadata, "prompt_token_count", None) or 0,
+            "cached_tokens": getattr(metadata, "cached_content_token_count", None) or 0,
+            "output_tokens": getattr(metadata, "candidates_token_count", None) or 0,
+            "total_tokens": getattr(metadata, "total_token_count", None) or 0,
+        }
+        
+        self.token_usage["requests"] += 1
+        for key, value in usage.items():
+            self.token_usage[key] += value
+        
+        return usage
+            
+    def parse_category(self, text: str) -> Optional[str]:
+        """
+        Extract the category from the "Thể loại: ..." line of the analysis result
+        
+        Tolerates markdown around the label/value (e.g. "**Thể loại:** Tài liệu")
+        and different casing or Unicode normalization.
+        
+        Returns:
+            "Tài liệu", "Hóa đơn", "Ngữ cảnh" or None if not found
+        """
+        text = unicodedata.normalize("NFC", text)
+        match = re.search(
+            r"thể\s+loại[\s*_]*:[\s*_]*\[?\s*(tài\s+liệu|hóa\s+đơn|ngữ\s+cảnh)",
+            text,
+            re.IGNORECASE
+        )
+        if not match:
+            return None
+        value = " ".join(match.group(1).lower().split())
+        for category in self.max_output_tokens:
+            if category.lower() == value:
+                return category
+        return None
+    
+    def split_text(self, text: str, max_chars: Optional[int] = None) -> List[str]:
+        """
+        Split text into chunks for paginated TTS
+        
+        Paragraphs are kept together when possible. Longer paragraphs are split
+        on lines (OCR output), then sentences, then the last space before
+        max_chars; only a single word longer than max_chars is cut.
+        
+        Args:
+            text (str): Text to split
+            max_chars (int, optional): Max characters per chunk (default: self.chunk_max_chars)
+            
+        Returns:
+            List of non-empty text chunks
+        """
+        max_chars = max_chars or self.chunk_max_chars
+        
+        def split_piece(piece: str, separators: List[str]) -> List[str]:
+            piece = piece.strip()
+            if not piece:
+                return []
+            if len(piece) <= max_chars:
+                return [piece]
+            if separators:
+                parts = []
+                for part in re.split(separators[0], piece):
+                    parts.extend(split_piece(part, separators[1:]))
+                return parts
+            # No separator left: cut at the last space, hard cut only inside an overlong word
+            parts = []
+            while len(piece) > max_chars:
+                cut = piece.rfind(" ", 0, max_chars + 1)
+                if cut <= 0:
+                    cut = max_chars
+                parts.append(piece[:cut].strip())
+                piece = piece[cut:].strip()
+            if piece:
+                parts.append(piece)
+            return parts
+        
+        pieces = []
+        for paragraph in re.split(r"\n\s*\n", text):
+            pieces.extend(split_piece(paragraph, [r"\n", r"(?<=[.!?…])\s+"]))
+        
+        # Pack pieces into chunks up to max_chars
+        chunks = []
+        current = ""
+        for piece in pieces:
+            if current and len(current) + len(piece) + 1 > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n{piece}" if current else piece
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    @staticmethod
+    def chunk_path(output_mp3_path: str, index: int) -> str:
+        """Get the MP3 path of a paginated audio chunk"""
+        base_path, extension = os.path.splitext(output_mp3_path)
+        return f"{base_path}_part{index}{extension or '.mp3'}"
+    
+    def synthesize(self, text: str, output_mp3_path: str, voice_id: Optional[str] = None) -> str:
+        """
+        Convert text to speech and save as MP3 file
+        
+        Args:
+            text (str): Text to speak
+            output_mp3_path (str): Path for output MP3 file
+            voice_id (str, optional): ElevenLabs voice ID (default: self.voice_id)
+            
+        Returns:
+            Path of the saved MP3 file
+        """
+        print("🔊 Đang chuyển văn bản thành giọng nói...")
+        
+        audio_stream = self.eleven_client.text_to_speech.convert(
+            text=text,
+            voice_id=voice_id or self.voice_id,
+            model_id="eleven_flash_v2_5",
+            output_format="mp3_44100_128",
+        )
+        
+        output_dir = os.path.dirname(output_mp3_path)
+        if output_dir:  # Only create directory if output_dir is not empty
+            os.makedirs(output_dir, exist_ok=True)
+        with open(output_mp3_path, "wb") as f:
+            for chunk in audio_stream:
+                f.write(chunk)
+        
+        print(f"✅ Đã lưu file âm thanh tại: {output_mp3_path}")
+        return output_mp3_path
+            
+    def convert(
+        self,
+        image_path: str,
+        output_mp3_path: str,
+        category: Optional[str] = None,
+        paginated: bool = False,
+        prefetch_chunks: int = 2,
+        mime_type: str = "image/jpeg",
+        voice_id: Optional[str] = None
+    ) -> Dict[str, Any]:
         """
         Convert image to speech MP3 file
         
         Args:
             image_path (str): Path to input image file
             output_mp3_path (str): Path for output MP3 file
+            category (str, optional): Expected category ("Tài liệu", "Hóa đơn", "Ngữ cảnh"),
+                sent to Gemini as a hint and used to pick the output token cap
+            paginated (bool): For [Tài liệu] results, split the text into chunks and only
+                synthesize the first `prefetch_chunks` chunks (see chunk_path/synthesize)
+            prefetch_chunks (int): Number of chunks synthesized up front in paginated mode
+            mime_type (str): Image MIME type sent to Gemini (default: image/jpeg)
+            voice_id (str, optional): ElevenLabs voice ID for this call (default: self.voice_id)
             
         Returns:
-            Dict with success status and details
+            Dict with success status and details ("truncated" is True when Gemini
+            stopped at the output token cap). In paginated mode it also contains
+            "text_chunks" and "audio_chunks" (path per chunk, None if not synthesized yet)
         """
+        voice_id = voice_id or self.voice_id
+        
         try:
             # Step 1: Check if image exists
             if not os.path.exists(image_path):
@@ -87,43 +374,67 @@ Nội dung: <nội dung tương ứng>
             with open(image_path, "rb") as f:
                 image_bytes = f.read()
             
+            contents = [types.Part.from_bytes(data=image_bytes, mime_type=mime_type)]
+            if category:
+                contents.append(f"Thể loại: [{category}]")
+            
             response = self.gemini_client.models.generate_content(
                 model=self.model,
-                contents=[
-                    types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg"),
-                    self.prompt
-                ]
+                contents=contents,
+                config=self._build_generation_config(category)
             )
+            token_usage = self._record_usage(response)
             
-            text_result = response.text.strip()
+            text_result = (response.text or "").strip()
             print(f"📄 Kết quả phân tích (100 ký tự đầu): {text_result[:100]}...")
             
-            # Step 3: Convert text to speech with ElevenLabs
-            print("🔊 Đang chuyển văn bản thành giọng nói...")
-            
-            audio_stream = self.eleven_client.text_to_speech.convert(
-                text=text_result,
-                voice_id=self.voice_id,
-                model_id="eleven_flash_v2_5",
-                output_format="mp3_44100_128",
+            # Output cut by max_output_tokens: keep it, but flag it to the caller
+            truncated = bool(
+                response.candidates
+                and response.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS
             )
+            if truncated:
+                print("⚠️  Kết quả bị cắt do vượt giới hạn token đầu ra")
             
-            # Step 4: Save MP3 file
-            output_dir = os.path.dirname(output_mp3_path)
-            if output_dir:  # Only create directory if output_dir is not empty
-                os.makedirs(output_dir, exist_ok=True)
-            with open(output_mp3_path, "wb") as f:
-                for chunk in audio_stream:
-                    f.write(chunk)
+            category_result = self.parse_category(text_result)
             
-            print(f"✅ Đã lưu file âm thanh tại: {output_mp3_path}")
+            # Step 3: Paginated mode - only synthesize the first chunks of long documents
+            if paginated and category_result == "Tài liệu":
+                text_chunks = self.split_text(text_result)
+                if len(text_chunks) > 1:
+                    audio_chunks = [None] * len(text_chunks)
+                    for index in range(min(max(prefetch_chunks, 1), len(text_chunks))):
+                        audio_chunks[index] = self.synthesize(
+                            text_chunks[index],
+                            self.chunk_path(output_mp3_path, index),
+                            voice_id=voice_id
+                        )
+                    
+                    return {
+                        "success": True,
+                        "error": None,
+                        "text_result": text_result,
+                        "audio_path": audio_chunks[0],
+                        "voice_id": voice_id,
+                        "token_usage": token_usage,
+                        "category": category_result,
+                        "truncated": truncated,
+                        "text_chunks": text_chunks,
+                        "audio_chunks": audio_chunks
+                    }
+            
+            # Step 4: Convert the whole text to speech
+            self.synthesize(text_result, output_mp3_path, voice_id=voice_id)
             
             return {
                 "success": True,
                 "error": None,
                 "text_result": text_result,
                 "audio_path": output_mp3_path,
-                "voice_id": self.voice_id
+                "voice_id": voice_id,
+                "token_usage": token_usage,
+                "category": category_result,
+                "truncated": truncated
             }
             
         except Exception as e:
@@ -139,8 +450,18 @@ Nội dung: <nội dung tương ứng>
         self.voice_id = voice_id
     
     def set_prompt(self, prompt: str):
-        """Change analysis prompt"""
+        """Change analysis prompt (invalidates the cached system instruction)"""
         self.prompt = prompt
+        self._cache_name = None
+        self._cache_expires_at = 0.0
+        self._cache_unavailable = False
+        self._cache_size_checked = False
+        self._cache_retry_at = 0.0
+        self._cache_backoff_seconds = 0.0
+    
+    def get_token_usage(self) -> Dict[str, int]:
+        """Get cumulative Gemini token usage"""
+        return dict(self.token_usage)
 
 
 # Example usage: